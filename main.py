@@ -1,14 +1,19 @@
+import asyncio
 import imp
 import os
 from re import S
 
 import sentry_sdk
 from dotenv import load_dotenv
-from fastapi import FastAPI, UploadFile
+from fastapi import FastAPI, Request, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from sentry_sdk import capture_exception, configure_scope
 
 from src.amazon import *
+from src.analytics import *
+from src.events import *
+from src.http_cache import *
 from src.mongo import *
 from src.openai import *
 from src.postgres import *
@@ -39,6 +44,37 @@ app.include_router(router_openai)
 app.include_router(router_amazon)
 app.include_router(router_mongo)
 app.include_router(router_postgres)
+app.include_router(router_events)
+app.include_router(router_analytics)
+
+
+@app.on_event("startup")
+async def start_image_events():
+    # Relay image events from every worker to this worker's /events subscribers
+    broker.bind(asyncio.get_running_loop())
+    start_watch_images_mongo()
+    start_listen_images_postgres()
+
+
+@app.on_event("startup")
+async def prepare_images_version():
+    # The /images ETag counter, without it the Postgres listing is served uncached
+    try:
+        ensure_images_version_postgres()
+    except Exception as err:
+        capture_exception(err)
+
+
+@app.on_event("startup")
+async def prepare_label_stats():
+    # Create / backfill the label analytics. A failure here shouldn't stop the API:
+    # Mongo creates collections on first write and Postgres retries on the next write
+    for ensure_label_stats in (ensure_label_stats_mongo, ensure_label_stats_postgres):
+        try:
+            ensure_label_stats()
+        except Exception as err:
+            capture_exception(err)
+
 
 # Define Python user-defined exceptions
 
@@ -51,14 +87,27 @@ class SentryError(Exception):
 
 
 @app.get("/images")
-async def get_all_images(backend: str = "mongo"):
+async def get_all_images(request: Request, response: Response, backend: str = "mongo"):
     print(f"Getting all images from {backend}")
     if backend == "mongo":
-        images = await get_all_images_mongo()
+        etag = get_images_version_mongo()
     elif backend == "postgres":
-        images = await get_all_images_postgres()
+        etag = get_images_version_postgres()
     else:
         raise SentryError("Invalid backend specified")
+
+    # Nothing changed since the client's last poll, skip the fetch entirely
+    if etag is not None and etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified(etag, IMAGES_CACHE_MAX_AGE)
+
+    if backend == "mongo":
+        # get_all_images_mongo builds its own Response, so decorate that one
+        images = await get_all_images_mongo()
+        return set_cache_headers(images, etag, IMAGES_CACHE_MAX_AGE)
+    images = await get_all_images_postgres()
+    # Without a version counter the listing is served uncached
+    if etag is not None:
+        set_cache_headers(response, etag, IMAGES_CACHE_MAX_AGE)
     return images
 
 
@@ -66,19 +115,31 @@ async def get_all_images(backend: str = "mongo"):
 async def add_photo(file: UploadFile, backend: str = "mongo"):
     print(f"Uploading File ${file.filename} - ${file.content_type}")
 
-    # Attempt to upload the image to Amazon S3
+    # Upload to Amazon S3 and run Amazon Rekognition
+    if REKOGNITION_SOURCE == "s3":
+        # Rekognition reads the object back from S3, so it has to wait for the upload
+        s3_url = await run_in_threadpool(amazon_upload, file)
+        detection = await run_in_threadpool(amazon_detection, file)
+    else:
+        # Analyse the bytes we already hold, concurrently with the upload
+        image_bytes = await file.read()
+        await file.seek(0)
+        s3_url, detection = await asyncio.gather(
+            run_in_threadpool(amazon_upload, file),
+            amazon_detection_from_bytes(image_bytes))
+
+    # Check the image was uploaded to Amazon S3
     try:
-        s3_url = amazon_upload(file)
         # check if the file url is null
         if s3_url is None:
             raise SentryError("Error uploading image to Amazon S3")
     except SentryError as err:
         capture_exception(err)
 
-    # Attempt to detect labels and text in the image using Amazon Rekognition
+    # Check labels and text were detected in the image using Amazon Rekognition
     try:
-        # amazon_detection(file) returns a tuple of 3 lists
-        amzlabels, amztext, amzmoderation = amazon_detection(file)
+        # amazon_detection returns a tuple of 3 lists
+        amzlabels, amztext, amzmoderation = detection
         if not amzlabels and not amztext and not amzmoderation:
             raise SentryError("Error processing Amazon Rekognition")
     except SentryError as err:
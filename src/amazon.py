@@ -3,13 +3,17 @@ Amazon Web Services (AWS) functions
 """
 
 # Import
+import asyncio
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from botocore.config import Config
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 from fastapi import APIRouter, File, UploadFile
+from PIL import Image, ImageOps, UnidentifiedImageError
 from sentry_sdk import capture_exception, configure_scope
 
 # Create a new router for Postgres Routes
@@ -25,6 +29,20 @@ AWS_KEY = os.getenv('AMAZON_KEY_ID')
 AWS_SECRET = os.getenv('AMAZON_KEY_SECRET')
 AWS_BUCKET = os.getenv('AMAZON_S3_BUCKET')
 
+# Rekognition analysis settings
+# "bytes" sends an in-memory, downscaled copy so analysis can run alongside the S3 upload
+# "s3" has Rekognition read the uploaded object back from the bucket
+REKOGNITION_SOURCE = os.getenv('REKOGNITION_SOURCE', 'bytes')
+REKOGNITION_MAX_DIMENSION = int(os.getenv('REKOGNITION_MAX_DIMENSION', '1600'))
+REKOGNITION_WORKERS = int(os.getenv('REKOGNITION_WORKERS', '2'))
+
+# Rekognition only accepts JPEG / PNG and caps inline image bytes at 5MB
+REKOGNITION_FORMATS = ("JPEG", "PNG")
+REKOGNITION_MAX_BYTES = 5 * 1024 * 1024
+
+# Worker pool for CPU bound image downscaling, keeps it off the event loop
+ANALYSIS_EXECUTOR = ThreadPoolExecutor(max_workers=REKOGNITION_WORKERS)
+
 # print the variables above
 print(AWS_KEY)
 print(AWS_SECRET)
@@ -37,6 +55,11 @@ AWS_SESSION = boto3.Session(
     aws_secret_access_key=AWS_SECRET
 )
 
+# Build the clients once: a Session is not thread-safe, but the clients it
+# creates are, and uploads / analysis run concurrently in worker threads
+S3_CLIENT = AWS_SESSION.client("s3")
+REKOGNITION_CLIENT = AWS_SESSION.client("rekognition")
+
 
 @router_amazon.post(path="/upload-image-amazon/")
 def amazon_upload(file: UploadFile = File(...)) -> str:
@@ -48,14 +71,12 @@ def amazon_upload(file: UploadFile = File(...)) -> str:
     Returns:
         string: The uploaded file URL
     """
-    awsclient = AWS_SESSION.resource("s3",)
-    bucket = awsclient.Bucket(AWS_BUCKET)
     print("Attempting to upload to S3")
     try:
         # upload_fileobj takes a file-like object but run asycnchronously
         # so we need to check 
-        bucket.upload_fileobj(file.file, file.filename)
-        response = bucket.Object(file.filename).get()
+        S3_CLIENT.upload_fileobj(file.file, AWS_BUCKET, file.filename)
+        response = S3_CLIENT.head_object(Bucket=AWS_BUCKET, Key=file.filename)
         print(response)
         if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
             return f"https://{AWS_BUCKET}.s3.amazonaws.com/{file.filename}"
@@ -75,11 +96,9 @@ async def amazon_delete_one_s3(key: str) -> bool:
     Returns:
         bool: True if the file was deleted, False if not
     """
-    # Create an S3 Client from our authenticated AWS Session
-    # Use to delete our S3 file using the filename
-    awsclient = AWS_SESSION.client("s3",)
+    # Use the shared S3 Client to delete our S3 file using the filename
     try:
-        response = awsclient.delete_object(Bucket=AWS_BUCKET, Key=key)
+        response = S3_CLIENT.delete_object(Bucket=AWS_BUCKET, Key=key)
         print(f"Amazon Deletion {response}")
         if response["ResponseMetadata"]["HTTPStatusCode"] == 204:
             return True
@@ -95,15 +114,14 @@ async def amazon_delete_all_s3() -> bool:
     Returns:
         bool: True if the file was deleted, False if not
     """
-    # Create an S3 Client from our authenticated AWS Session
-    # Use to delete our S3 file using the filename
-    awsclient = AWS_SESSION.resource("s3",)
-    bucket = awsclient.Bucket(AWS_BUCKET)
-    print(f"Attempting to delete all files from S3 {bucket}")
-    objects_to_delete = [{'Key': obj.key} for obj in bucket.objects.all()]
+    # Use the shared S3 Client to list and delete every file in the bucket
+    print(f"Attempting to delete all files from S3 {AWS_BUCKET}")
+    paginator = S3_CLIENT.get_paginator("list_objects_v2")
+    objects_to_delete = [{'Key': obj['Key']}
+                         for page in paginator.paginate(Bucket=AWS_BUCKET) for obj in page.get('Contents', [])]
     # Delete the objects
     try:
-        response = bucket.delete_objects(Delete={'Objects': objects_to_delete})
+        response = S3_CLIENT.delete_objects(Bucket=AWS_BUCKET, Delete={'Objects': objects_to_delete})
         if response['ResponseMetadata']['HTTPStatusCode'] == 200:
             print("All objects deleted successfully")
             return True
@@ -114,22 +132,71 @@ async def amazon_delete_all_s3() -> bool:
         capture_exception(err)
 
 
-def amazon_detection(file):
+def amazon_prepare_image(image_bytes: bytes, max_dimension: int = REKOGNITION_MAX_DIMENSION) -> bytes:
+    """Downscales an image so it fits Rekognition's inline Bytes limits
+
+    Args:
+        image_bytes (bytes): The raw uploaded image
+        max_dimension (int): The longest side, in pixels, to send to Rekognition
+
+    Returns:
+        bytes: A JPEG / PNG no larger than max_dimension on its longest side
+    """
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        # Already small enough and in a format Rekognition accepts, send as is
+        if (max(image.size) <= max_dimension and image.format in REKOGNITION_FORMATS
+                and len(image_bytes) <= REKOGNITION_MAX_BYTES):
+            return image_bytes
+        # Re-encoding drops EXIF, so apply the orientation tag to the pixels first
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_dimension, max_dimension))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=85)
+        return output.getvalue()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as err:
+        # Let Rekognition decide what to do with anything Pillow cannot read
+        capture_exception(err)
+        return image_bytes
+
+
+async def amazon_detection_from_bytes(image_bytes: bytes):
+    """Detects labels, text, and moderation in an in-memory image
+
+    The image is downscaled once in the analysis worker pool, so this does not
+    depend on the S3 upload and can run concurrently with it.
+
+    Args:
+        image_bytes (bytes): The raw contents of the uploaded image
+
+    Returns:
+        detect_modified_labels, detect_text_list, detect_moderation_list: Labels List, Test List, Moderation List
+    """
+    loop = asyncio.get_running_loop()
+    prepared = await loop.run_in_executor(ANALYSIS_EXECUTOR, amazon_prepare_image, image_bytes)
+    return await loop.run_in_executor(None, amazon_detection, None, prepared)
+
+
+def amazon_detection(file, image_bytes: bytes = None):
     """Detects labels, text, and moderation in an image
 
     Args:
-        file (IO): A valid image file
+        file (IO): A valid image file, only used when image_bytes is not given
+        image_bytes (bytes, optional): Image bytes to analyse. Defaults to reading the uploaded S3 object.
 
     Returns:
         detect_modified_labels, detect_text_list, detect_moderation_list: Labels List, Test List, Moderation List
     """
-    awsclient = AWS_SESSION.client("rekognition")
-    detect_labels_res = awsclient.detect_labels(
-        Image={'S3Object': {'Bucket': AWS_BUCKET, 'Name': file.filename}})
-    detect_text_res = awsclient.detect_text(
-        Image={'S3Object': {'Bucket': AWS_BUCKET, 'Name': file.filename}})
-    detect_moderation_res = awsclient.detect_moderation_labels(
-        Image={'S3Object': {'Bucket': AWS_BUCKET, 'Name': file.filename}})
+    if image_bytes is not None:
+        image = {'Bytes': image_bytes}
+    else:
+        image = {'S3Object': {'Bucket': AWS_BUCKET, 'Name': file.filename}}
+
+    detect_labels_res = REKOGNITION_CLIENT.detect_labels(Image=image)
+    detect_text_res = REKOGNITION_CLIENT.detect_text(Image=image)
+    detect_moderation_res = REKOGNITION_CLIENT.detect_moderation_labels(Image=image)
 
     detect_moderation_list = []
     for label in detect_moderation_res["ModerationLabels"]:
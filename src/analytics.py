@@ -0,0 +1,107 @@
+"""
+Label and text analytics over the Amazon Rekognition results
+"""
+
+from datetime import date
+
+from fastapi import APIRouter, HTTPException, Query
+
+from src.mongo import (co_occurrence_mongo, label_counts_over_time_mongo,
+                       rebuild_label_stats_mongo, top_labels_mongo)
+from src.postgres import (co_occurrence_postgres,
+                          label_counts_over_time_postgres,
+                          rebuild_label_stats_postgres, top_labels_postgres)
+
+# Create a new router for Analytics Routes
+router_analytics = APIRouter()
+
+KINDS = ("label", "text")
+BACKENDS = ("mongo", "postgres")
+
+
+def check_params(backend: str, kind: str = "label"):
+    """Rejects unknown backends and kinds
+
+    Args:
+        backend (str): "mongo" or "postgres"
+        kind (str): "label" for ai_labels, "text" for ai_text
+    """
+    if backend not in BACKENDS:
+        raise HTTPException(status_code=400, detail="Invalid backend specified")
+    if kind not in KINDS:
+        raise HTTPException(status_code=400, detail="Invalid kind specified")
+
+
+@router_analytics.get("/analytics/top-labels")
+async def top_labels(backend: str = "mongo", kind: str = "label", limit: int = Query(20, ge=1, le=1000)):
+    """Most frequent labels (or text lines) across all images
+
+    Args:
+        backend (str, optional): Defaults to "mongo".
+        kind (str, optional): "label" or "text". Defaults to "label".
+        limit (int, optional): 1 to 1000. Defaults to 20.
+
+    Returns:
+        list: {"value", "count"} ordered by count
+    """
+    check_params(backend, kind)
+    if backend == "mongo":
+        return top_labels_mongo(kind, limit)
+    return top_labels_postgres(kind, limit)
+
+
+@router_analytics.get("/analytics/label-counts")
+async def label_counts_over_time(backend: str = "mongo", kind: str = "label", value: str = None,
+                                 start: date = None, end: date = None):
+    """Images added per day carrying each label (or text line)
+
+    Args:
+        backend (str, optional): Defaults to "mongo".
+        kind (str, optional): "label" or "text". Defaults to "label".
+        value (str, optional): Only this label. Defaults to all labels.
+        start (date, optional): First day included. Defaults to the beginning.
+        end (date, optional): Last day included. Defaults to today.
+
+    Returns:
+        list: {"day", "value", "count"} ordered by day
+    """
+    check_params(backend, kind)
+    if backend == "mongo":
+        return label_counts_over_time_mongo(kind, value, start, end)
+    return label_counts_over_time_postgres(kind, value, start, end)
+
+
+@router_analytics.get("/analytics/co-occurrence")
+async def co_occurrence(backend: str = "mongo", label: str = None, limit: int = Query(20, ge=1, le=1000)):
+    """Label pairs that appear on the same image
+
+    Args:
+        backend (str, optional): Defaults to "mongo".
+        label (str, optional): Only pairs involving this label. Defaults to all pairs.
+        limit (int, optional): 1 to 1000. Defaults to 20.
+
+    Returns:
+        list: {"a", "b", "count"} ordered by count
+    """
+    check_params(backend)
+    if backend == "mongo":
+        return co_occurrence_mongo(label, limit)
+    return co_occurrence_postgres(label, limit)
+
+
+@router_analytics.post("/analytics/rebuild")
+async def rebuild_analytics(backend: str = "mongo"):
+    """Recomputes the analytics from the images themselves
+
+    The summaries are maintained on every insert and delete, this is only
+    needed after writes that bypass the API.
+
+    Args:
+        backend (str, optional): Defaults to "mongo".
+    """
+    check_params(backend)
+    if backend == "mongo":
+        rebuild_label_stats_mongo()
+    else:
+        rebuild_label_stats_postgres()
+    return {"message": f"Rebuilt {backend} analytics"}
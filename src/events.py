@@ -0,0 +1,186 @@
+"""
+Server-sent events feed of image additions and deletions
+"""
+
+import asyncio
+import json
+import os
+import uuid
+from collections import deque
+
+from dotenv import load_dotenv
+from fastapi import APIRouter, Request
+from fastapi.responses import StreamingResponse
+
+# Load dotenv in the base root refers to application_top
+APP_ROOT = os.path.join(os.path.dirname(__file__), '..')
+dotenv_path = os.path.join(APP_ROOT, '.env')
+load_dotenv(dotenv_path)
+
+# Events kept for clients resuming with Last-Event-ID
+EVENTS_HISTORY = int(os.getenv('EVENTS_HISTORY', '256'))
+# Events buffered per connected client before it is told to reload
+EVENTS_CLIENT_BUFFER = int(os.getenv('EVENTS_CLIENT_BUFFER', '64'))
+# Seconds between keepalive comments so proxies don't drop idle streams
+EVENTS_KEEPALIVE = int(os.getenv('EVENTS_KEEPALIVE', '15'))
+# Postgres NOTIFY channel shared by every worker
+EVENTS_CHANNEL = "images"
+
+# Create a new router for Event Routes
+router_events = APIRouter()
+
+
+def image_event(type: str, backend: str, id, name: str = None, url: str = None) -> dict:
+    """Builds an image event payload
+
+    Kept small on purpose: Postgres NOTIFY payloads are capped at 8000 bytes,
+    clients can fetch the full record from /get-image-{backend}/{id}.
+
+    Args:
+        type (str): "added" or "deleted"
+        backend (str): "mongo" or "postgres"
+        id: The image ID
+        name (str, optional): Name of the image
+        url (str, optional): S3 URL of the image
+
+    Returns:
+        dict: The event payload
+    """
+    image = {"id": str(id)}
+    if name is not None:
+        image["name"] = name
+    if url is not None:
+        image["url"] = url
+    return {"type": type, "backend": backend, "image": image}
+
+
+class EventBroker:
+    """Fans image events out to every subscriber of this worker
+
+    Event ids are "<epoch>-<seq>" where epoch is unique per process, so a
+    client resuming against a different (or restarted) worker is detected
+    and told to reload instead of silently missing events.
+    """
+
+    def __init__(self, history: int = EVENTS_HISTORY, buffer: int = EVENTS_CLIENT_BUFFER):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self.history = deque(maxlen=history)
+        self.buffer = buffer
+        self.subscribers = set()
+        self.sources = set()
+        self.loop = None
+
+    def bind(self, loop):
+        """Binds the broker to the event loop its subscribers live on"""
+        self.loop = loop
+
+    def has_source(self, backend: str) -> bool:
+        """True if a cross-worker feed (change stream / LISTEN) delivers this backend's events"""
+        return backend in self.sources
+
+    def publish(self, event: dict):
+        """Assigns an id to an event and queues it for every subscriber
+
+        Must be called from the broker's event loop thread.
+        """
+        self.seq += 1
+        event = {"id": f"{self.epoch}-{self.seq}", **event}
+        self.history.append((self.seq, event))
+        for queue in self.subscribers:
+            self._offer(queue, event)
+
+    def publish_threadsafe(self, event: dict):
+        """Publishes an event from a listener thread"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.publish, event)
+
+    def subscribe(self, last_event_id: str = None) -> asyncio.Queue:
+        """Registers a subscriber, replaying anything missed since last_event_id
+
+        Args:
+            last_event_id (str, optional): The last event id the client saw
+
+        Returns:
+            asyncio.Queue: The subscriber's bounded event queue
+        """
+        queue = asyncio.Queue(maxsize=self.buffer)
+        if last_event_id:
+            missed = self._missed_since(last_event_id)
+            if missed is None or len(missed) > self.buffer:
+                queue.put_nowait({"type": "reset"})
+            else:
+                for event in missed:
+                    queue.put_nowait(event)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        """Removes a subscriber"""
+        self.subscribers.discard(queue)
+
+    def _missed_since(self, last_event_id: str):
+        # None means we can't tell what the client missed
+        epoch, _, seq = last_event_id.partition("-")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        oldest = self.history[0][0] if self.history else self.seq + 1
+        if seq > self.seq or seq < oldest - 1:
+            return None
+        return [event for event_seq, event in self.history if event_seq > seq]
+
+    def _offer(self, queue: asyncio.Queue, event: dict):
+        # A slow client must not hold events for everyone else: drop its
+        # backlog and tell it to reload the listing instead
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait({"type": "reset"})
+
+
+broker = EventBroker()
+
+
+def format_sse(event: dict) -> str:
+    """Formats an event as a server-sent events message"""
+    message = ""
+    if "id" in event:
+        message += f"id: {event['id']}\n"
+    message += f"event: {event['type']}\n"
+    message += f"data: {json.dumps(event)}\n\n"
+    return message
+
+
+@router_events.get("/events")
+async def image_events(request: Request, last_event_id: str = None):
+    """Streams image added / deleted events as server-sent events
+
+    Clients load /images once and apply events incrementally. A "reset" event
+    means events were missed and the listing should be fetched again.
+
+    Args:
+        request (Request): The incoming request
+        last_event_id (str, optional): Resume after this event id. Defaults to the Last-Event-ID header.
+
+    Returns:
+        StreamingResponse: A text/event-stream response
+    """
+    queue = broker.subscribe(last_event_id or request.headers.get("last-event-id"))
+
+    async def stream():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event)
+        finally:
+            broker.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,83 @@
+"""
+HTTP caching helpers (ETag / Cache-Control) for the image read endpoints
+"""
+
+import hashlib
+import os
+
+from dotenv import load_dotenv
+from fastapi import Response
+
+# Load dotenv in the base root refers to application_top
+APP_ROOT = os.path.join(os.path.dirname(__file__), '..')
+dotenv_path = os.path.join(APP_ROOT, '.env')
+load_dotenv(dotenv_path)
+
+# Seconds a browser / CDN may reuse a response before revalidating with us.
+# The listing changes on every upload so keep it short, single images never change.
+IMAGES_CACHE_MAX_AGE = int(os.getenv('IMAGES_CACHE_MAX_AGE', '5'))
+IMAGE_CACHE_MAX_AGE = int(os.getenv('IMAGE_CACHE_MAX_AGE', '3600'))
+
+
+def make_etag(*parts) -> str:
+    """Builds a strong ETag from the given parts
+
+    Args:
+        parts: Any values that identify the version of a resource
+
+    Returns:
+        str: A quoted ETag value
+    """
+    digest = hashlib.sha1(
+        ":".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Checks an If-None-Match header against an ETag (weak comparison)
+
+    Args:
+        if_none_match (str): The raw If-None-Match request header, if any
+        etag (str): The current ETag of the resource
+
+    Returns:
+        bool: True if the client already holds the current version, False if not
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    current = etag.removeprefix("W/")
+    for candidate in if_none_match.split(","):
+        if candidate.strip().removeprefix("W/") == current:
+            return True
+    return False
+
+
+def set_cache_headers(response: Response, etag: str, max_age: int) -> Response:
+    """Adds ETag and Cache-Control headers to a response
+
+    Args:
+        response (Response): The response to decorate
+        etag (str): The current ETag of the resource
+        max_age (int): Seconds the response may be reused without revalidation
+
+    Returns:
+        Response: The same response
+    """
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = f"public, max-age={max_age}, must-revalidate"
+    return response
+
+
+def not_modified(etag: str, max_age: int) -> Response:
+    """Builds an empty 304 Not Modified response
+
+    Args:
+        etag (str): The current ETag of the resource
+        max_age (int): Seconds the response may be reused without revalidation
+
+    Returns:
+        Response: A 304 response carrying the cache headers
+    """
+    return set_cache_headers(Response(status_code=304), etag, max_age)
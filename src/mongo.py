@@ -4,16 +4,23 @@ Functions for interacting with MongoDB.
 
 import os
 import random
+import threading
+import time
 import urllib.parse
+from datetime import date
 
 import pymongo
 from bson import json_util
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
-from fastapi import APIRouter, Response
-from pymongo import MongoClient
+from fastapi import APIRouter, Request, Response
+from pymongo import MongoClient, UpdateOne
 from pymongo.server_api import ServerApi
-from sentry_sdk import configure_scope
+from sentry_sdk import capture_exception, configure_scope
+
+from src.events import broker, image_event
+from src.http_cache import (IMAGE_CACHE_MAX_AGE, etag_matches, make_etag,
+                            not_modified, set_cache_headers)
 
 # Load dotenv in the base root refers to application_top
 APP_ROOT = os.path.join(os.path.dirname(__file__), '..')
@@ -59,6 +66,14 @@ except Exception as e:
 db = client.Images
 collection = db.vite_demo_images
 
+# Single counter document bumped on every insert / delete, backs the /images ETag
+image_versions = db.vite_demo_image_versions
+
+# Label / text analytics, kept up to date on every insert and delete
+label_counts = db.vite_demo_image_label_counts
+label_daily_counts = db.vite_demo_image_label_daily_counts
+label_pairs = db.vite_demo_image_label_pairs
+
 # Create a new router for MongoDB Routes
 router_mongo = APIRouter()
 
@@ -74,7 +89,6 @@ async def add_sample_mongo():
     return {"message": f"Mongo added id: {result.inserted_id}"}
 
 
-@router_mongo.get(path="/get-image-mongo/{id}")
 async def get_one_mongo(id: str):
     # Fetch one document from the collection
     result = collection.find_one({"_id": ObjectId(id)})
@@ -83,6 +97,33 @@ async def get_one_mongo(id: str):
     return result
 
 
+@router_mongo.get(path="/get-image-mongo/{id}")
+async def get_image_mongo(id: str, request: Request, response: Response):
+    # Images are never updated in place, so the id alone identifies the version.
+    # Only a projected existence check is needed before answering 304.
+    etag = make_etag("mongo", id)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        if collection.find_one({"_id": ObjectId(id)}, {"_id": 1}) is not None:
+            return not_modified(etag, IMAGE_CACHE_MAX_AGE)
+    result = await get_one_mongo(id)
+    set_cache_headers(response, etag, IMAGE_CACHE_MAX_AGE)
+    return result
+
+
+def get_images_version_mongo() -> str:
+    # One point read: the counter bumped by every insert / delete through the API
+    doc = image_versions.find_one({"_id": "images"})
+    return make_etag("mongo", doc["version"] if doc else 0)
+
+
+def bump_images_version_mongo():
+    # Invalidates the /images ETag, the image write itself has already happened
+    try:
+        image_versions.update_one({"_id": "images"}, {"$inc": {"version": 1}}, upsert=True)
+    except Exception as err:
+        capture_exception(err)
+
+
 @router_mongo.get("/get-all-images-mongo")
 async def get_all_images_mongo():
     # Get all documents from the collection
@@ -107,6 +148,16 @@ async def add_image_mongo(name: str, url: str, ai_labels: list, ai_text: list):
                 "ai_labels": ai_labels, "ai_text": ai_text}
     result = collection.insert_one(document)
     print(result.inserted_id)
+    bump_images_version_mongo()
+    # The image is stored either way, a failed analytics update only leaves the
+    # summaries stale until POST /analytics/rebuild
+    try:
+        update_label_stats_mongo(result.inserted_id, ai_labels, ai_text, 1)
+    except Exception as err:
+        capture_exception(err)
+    # The change stream delivers the event to every worker when it is running
+    if not broker.has_source("mongo"):
+        broker.publish(image_event("added", "mongo", result.inserted_id, name, url))
     return {"message": f"Mongo added id: {result.inserted_id}"}
 
 
@@ -114,6 +165,14 @@ async def add_image_mongo(name: str, url: str, ai_labels: list, ai_text: list):
 async def delete_all_mongo(key: str):
     # Delete all documents from the collection
     result = collection.delete_many({key: {"$exists": True}})
+    if result.deleted_count:
+        bump_images_version_mongo()
+        # The change stream reports each document, without it tell clients to reload
+        if not broker.has_source("mongo"):
+            broker.publish({"type": "reset"})
+    # Bulk deletes are rare, recompute the analytics rather than track each document
+    if result.deleted_count:
+        rebuild_label_stats_mongo()
     return {"message": f"Mongo deleted {result.deleted_count} documents"}
 
 
@@ -123,5 +182,163 @@ async def delete_one_mongo(id: str):
     with configure_scope() as scope:
         scope.set_transaction_name("Mongo Delete Image")
 
-    result = collection.delete_one({"_id": ObjectId(id)})
-    return {"message": f"Mongo deleted {result.deleted_count} documents"}
+    # find_one_and_delete hands back the labels we need to decrement
+    result = collection.find_one_and_delete(
+        {"_id": ObjectId(id)}, {"ai_labels": 1, "ai_text": 1})
+    deleted_count = 1 if result else 0
+    if result:
+        bump_images_version_mongo()
+        try:
+            update_label_stats_mongo(result["_id"], result.get("ai_labels"), result.get("ai_text"), -1)
+        except Exception as err:
+            capture_exception(err)
+    if deleted_count and not broker.has_source("mongo"):
+        broker.publish(image_event("deleted", "mongo", id))
+    return {"message": f"Mongo deleted {deleted_count} documents"}
+
+
+def update_label_stats_mongo(image_id: ObjectId, ai_labels: list, ai_text: list, amount: int):
+    """Applies one image's labels and text to the analytics collections
+
+    Args:
+        image_id (ObjectId): The image _id, its timestamp is the day bucket
+        ai_labels (list): Labels identified by Amazon Rekognition
+        ai_text (list): Text identified by Amazon Rekognition
+        amount (int): 1 when the image was added, -1 when it was deleted
+    """
+    # ObjectId timestamps are UTC, matching the Postgres day buckets
+    day = image_id.generation_time.strftime("%Y-%m-%d")
+    counts, daily, pairs = [], [], []
+    for kind, values in (("label", ai_labels), ("text", ai_text)):
+        for value in set(values or []):
+            counts.append({"kind": kind, "value": value})
+            daily.append({"kind": kind, "value": value, "day": day})
+    labels = sorted(set(ai_labels or []))
+    for i, a in enumerate(labels):
+        for b in labels[i + 1:]:
+            pairs.append({"a": a, "b": b})
+
+    for stats, keys in ((label_counts, counts), (label_daily_counts, daily), (label_pairs, pairs)):
+        if keys:
+            stats.bulk_write([UpdateOne({"_id": key}, {"$inc": {"count": amount}}, upsert=True)
+                              for key in keys], ordered=False)
+            # Only the keys just decremented can have dropped to zero
+            if amount < 0:
+                stats.delete_many({"_id": {"$in": keys}, "count": {"$lte": 0}})
+
+
+def rebuild_label_stats_mongo():
+    """Recomputes the analytics collections from scratch with $unwind / $group"""
+    with configure_scope() as scope:
+        scope.set_transaction_name("Mongo Rebuild Label Stats")
+
+    def tagged(field, kind):
+        # Distinct values of an array field, tagged with their kind
+        return {"$map": {"input": {"$setUnion": [{"$ifNull": [field, []]}, []]},
+                         "as": "value", "in": {"kind": kind, "value": "$$value"}}}
+
+    collection.aggregate([
+        {"$project": {
+            "day": {"$dateToString": {"format": "%Y-%m-%d", "date": {"$toDate": "$_id"}}},
+            "values": {"$concatArrays": [tagged("$ai_labels", "label"), tagged("$ai_text", "text")]},
+        }},
+        {"$unwind": "$values"},
+        {"$group": {"_id": {"kind": "$values.kind", "value": "$values.value", "day": "$day"},
+                    "count": {"$sum": 1}}},
+        {"$out": label_daily_counts.name},
+    ])
+    label_daily_counts.aggregate([
+        {"$group": {"_id": {"kind": "$_id.kind", "value": "$_id.value"}, "count": {"$sum": "$count"}}},
+        {"$out": label_counts.name},
+    ])
+    collection.aggregate([
+        {"$project": {"a": {"$setUnion": [{"$ifNull": ["$ai_labels", []]}, []]}}},
+        {"$project": {"a": 1, "b": "$a"}},
+        {"$unwind": "$a"},
+        {"$unwind": "$b"},
+        {"$match": {"$expr": {"$lt": ["$a", "$b"]}}},
+        {"$group": {"_id": {"a": "$a", "b": "$b"}, "count": {"$sum": 1}}},
+        {"$out": label_pairs.name},
+    ])
+
+
+def ensure_label_stats_mongo():
+    """Indexes the analytics collections and backfills them on first run"""
+    label_counts.create_index([("_id.kind", 1), ("count", -1)])
+    label_daily_counts.create_index([("_id.kind", 1), ("_id.day", 1)])
+    label_pairs.create_index([("count", -1)])
+    if label_counts.estimated_document_count() == 0 and collection.estimated_document_count() > 0:
+        rebuild_label_stats_mongo()
+
+
+def top_labels_mongo(kind: str, limit: int) -> list:
+    # Most frequent labels (or text lines) across all images
+    stats = label_counts.find({"_id.kind": kind}).sort("count", -1).limit(limit)
+    return [{"value": s["_id"]["value"], "count": s["count"]} for s in stats]
+
+
+def label_counts_over_time_mongo(kind: str, value: str = None, start: date = None, end: date = None) -> list:
+    # Images added per day carrying each label (or text line)
+    query = {"_id.kind": kind}
+    if value is not None:
+        query["_id.value"] = value
+    if start is not None or end is not None:
+        query["_id.day"] = {}
+        if start is not None:
+            query["_id.day"]["$gte"] = start.isoformat()
+        if end is not None:
+            query["_id.day"]["$lte"] = end.isoformat()
+    stats = label_daily_counts.find(query).sort([("_id.day", 1), ("count", -1)])
+    return [{"day": s["_id"]["day"], "value": s["_id"]["value"], "count": s["count"]} for s in stats]
+
+
+def co_occurrence_mongo(label: str = None, limit: int = 20) -> list:
+    # Label pairs appearing on the same image, optionally involving one label
+    query = {"$or": [{"_id.a": label}, {"_id.b": label}]} if label is not None else {}
+    stats = label_pairs.find(query).sort("count", -1).limit(limit)
+    return [{"a": s["_id"]["a"], "b": s["_id"]["b"], "count": s["count"]} for s in stats]
+
+
+def watch_images_mongo():
+    """Relays collection inserts / deletes to the event broker via a change stream
+
+    Runs forever in a background thread. Change streams need a replica set
+    (Atlas always is one); while the stream is down, add_image_mongo and
+    delete_one_mongo publish their own events to this worker only.
+    """
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "delete"]}}}]
+    resume_token = None
+    delay = 5
+    while True:
+        try:
+            with collection.watch(pipeline, resume_after=resume_token) as stream:
+                broker.sources.add("mongo")
+                delay = 5
+                for change in stream:
+                    # Taken before handling, so a malformed change is skipped on resume
+                    resume_token = stream.resume_token
+                    if change["operationType"] == "insert":
+                        doc = change["fullDocument"]
+                        event = image_event("added", "mongo", doc["_id"], doc.get("name"), doc.get("url"))
+                    else:
+                        event = image_event("deleted", "mongo", change["documentKey"]["_id"])
+                    broker.publish_threadsafe(event)
+        except pymongo.errors.OperationFailure as err:
+            capture_exception(err)
+            # 40573: not a replica set, change streams will never work here
+            if err.code == 40573:
+                print("MongoDB change streams unavailable, publishing image events locally")
+                return
+            # A stale resume token would fail forever, start from "now" instead
+            resume_token = None
+        except Exception as err:
+            capture_exception(err)
+        finally:
+            broker.sources.discard("mongo")
+        time.sleep(delay)
+        delay = min(delay * 2, 300)
+
+
+def start_watch_images_mongo():
+    """Starts the change stream watcher in a daemon thread"""
+    threading.Thread(target=watch_images_mongo, name="mongo-change-stream", daemon=True).start()
@@ -2,16 +2,25 @@
 Functions for interacting with Postgres.
 """
 
+import json
 import os
+import select
+import threading
+import time
 from datetime import date
 from typing import List, Optional
 
 import psycopg2
 from dotenv import load_dotenv
-from fastapi import APIRouter, Response, encoders
+from fastapi import APIRouter, Request, Response, encoders
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from pydantic import BaseModel
 from sentry_sdk import capture_exception, configure_scope
 
+from src.events import EVENTS_CHANNEL, broker, image_event
+from src.http_cache import (IMAGE_CACHE_MAX_AGE, etag_matches, make_etag,
+                            not_modified, set_cache_headers)
+
 # Load dotenv in the base root refers to application_top
 APP_ROOT = os.path.join(os.path.dirname(__file__), '..')
 dotenv_path = os.path.join(APP_ROOT, '.env')
@@ -34,6 +43,9 @@ router_postgres = APIRouter()
 print(DB, HOST, PORT, USER, PW)
 print(conn)
 
+# Set once the label analytics tables are known to exist
+label_stats_ready = False
+
 
 class ImageModel(BaseModel):
     id: int
@@ -48,7 +60,6 @@ class ImageModel(BaseModel):
     ai_text: Optional[list]
 
 
-@router_postgres.get("/get-image-postgres/{id}", response_model=ImageModel, response_model_exclude_unset=True)
 async def get_image_postgres(id: int):
     """Fetches a single image from Postgres
 
@@ -70,6 +81,92 @@ async def get_image_postgres(id: int):
         capture_exception(err)
 
 
+@router_postgres.get("/get-image-postgres/{id}", response_model=ImageModel, response_model_exclude_unset=True)
+async def get_image_postgres_cached(id: int, request: Request, response: Response):
+    """Fetches a single image from Postgres, honoring If-None-Match
+
+    Args:
+        id (int): The Image ID
+        request (Request): The incoming request
+        response (Response): The outgoing response, used to set cache headers
+    """
+    # Images are never updated in place, so the id alone identifies the version
+    etag = make_etag("postgres", id)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        exists = False
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT 1 FROM images WHERE id = %s", (id,))
+            exists = cur.fetchone() is not None
+        except Exception as err:
+            conn.rollback()
+            capture_exception(err)
+        finally:
+            cur.close()
+        if exists:
+            return not_modified(etag, IMAGE_CACHE_MAX_AGE)
+    item = await get_image_postgres(id)
+    set_cache_headers(response, etag, IMAGE_CACHE_MAX_AGE)
+    return item
+
+
+def get_images_version_postgres() -> str:
+    """Reads the images version counter, bumped on every insert / delete
+
+    Returns:
+        str: An ETag for the current contents of the table, None if the
+        counter is unavailable (the listing is then served uncached)
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT version FROM image_versions WHERE name = 'images'")
+        row = cur.fetchone()
+    except Exception as err:
+        conn.rollback()
+        capture_exception(err)
+        return None
+    finally:
+        cur.close()
+    if row is None:
+        return None
+    return make_etag("postgres", row[0])
+
+
+def bump_images_version_postgres(cur):
+    """Invalidates the /images ETag inside the transaction that changed an image
+
+    Runs in a savepoint so a missing counter table never rolls back the image.
+
+    Args:
+        cur (cursor): A cursor inside the transaction that changed the image
+    """
+    cur.execute("SAVEPOINT images_version")
+    try:
+        cur.execute("UPDATE image_versions SET version = version + 1 WHERE name = 'images'")
+        cur.execute("RELEASE SAVEPOINT images_version")
+    except Exception as err:
+        cur.execute("ROLLBACK TO SAVEPOINT images_version")
+        capture_exception(err)
+
+
+def ensure_images_version_postgres():
+    """Creates and seeds the images version counter"""
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS image_versions (
+                   name text PRIMARY KEY, version bigint NOT NULL)""")
+        cur.execute(
+            "INSERT INTO image_versions (name, version) VALUES ('images', 0) ON CONFLICT (name) DO NOTHING")
+        conn.commit()
+    except Exception as err:
+        conn.rollback()
+        capture_exception(err)
+        raise
+    finally:
+        cur.close()
+
+
 async def get_all_images_postgres(response_model=List[ImageModel]):
     """Fetches all images from Postgres.
 
@@ -113,16 +210,25 @@ async def add_image_postgres(name: str, url: str, ai_labels: list, ai_text: list
     with configure_scope() as scope:
         scope.set_transaction_name("Postgres Add Image")
 
+    prepare_label_stats_postgres()
+
     cur = conn.cursor()
     # Note: don't be tempted to use string interpolation on the SQL string ...
     # have never gotten that to accept a List into a text[] or varchar[] Postgres column
-    SQL = "INSERT INTO images (name, url, ai_labels, ai_text) VALUES (%s, %s, %s, %s)"
+    # date_added is the day bucket for the label analytics, taken in UTC to match Mongo's ObjectId days
+    SQL = "INSERT INTO images (name, url, ai_labels, ai_text, date_added) VALUES (%s, %s, %s, %s, (now() AT TIME ZONE 'UTC')::date) RETURNING id, date_added"
     DATA = (name, url, ai_labels, ai_text)
 
-    # Attempt to write the image metadata to Postgres
+    # Attempt to write the image metadata and its label analytics to Postgres
     try:
         cur.execute(SQL, DATA)
+        image_id, date_added = cur.fetchone()
+        bump_images_version_postgres(cur)
+        apply_label_stats_postgres(cur, date_added, ai_labels, ai_text, 1)
+        event = image_event("added", "postgres", image_id, name, url)
+        notify_image_event_postgres(cur, event)
         conn.commit()
+        publish_image_event_postgres(event)
     except Exception as err:
         conn.rollback()
         capture_exception(err)
@@ -137,20 +243,295 @@ async def delete_image_postgres(id: int):
     Args:
         id (int): ID of the image to delete
     """
+    prepare_label_stats_postgres()
+
     cur = conn.cursor()
-    SQL = "DELETE FROM images WHERE id = %s"
+    SQL = "DELETE FROM images WHERE id = %s RETURNING date_added, ai_labels, ai_text"
     DATA = (id,)
 
     with configure_scope() as scope:
         scope.set_transaction_name("Postgres Delete Image")
 
-    # Attempt to delete the image from Postgres
+    # Attempt to delete the image and its label analytics from Postgres
     try:
         cur.execute(SQL, DATA)
+        image = cur.fetchone()
+        event = None
+        if image is not None:
+            bump_images_version_postgres(cur)
+            apply_label_stats_postgres(cur, *image, -1)
+            event = image_event("deleted", "postgres", id)
+            notify_image_event_postgres(cur, event)
         conn.commit()
+        if event is not None:
+            publish_image_event_postgres(event)
     except Exception as err:
         conn.rollback()
         capture_exception(err)
 
     # Close the connection
     cur.close()
+
+
+def update_label_stats_postgres(cur, day: date, ai_labels: list, ai_text: list, amount: int):
+    """Applies one image's labels and text to the analytics tables
+
+    Args:
+        cur (cursor): A cursor inside the transaction that changed the image
+        day (date): The day the image was added, None skips the daily counts
+        ai_labels (list): Labels identified by Amazon Rekognition
+        ai_text (list): Text identified by Amazon Rekognition
+        amount (int): 1 when the image was added, -1 when it was deleted
+    """
+    for kind, values in (("label", ai_labels), ("text", ai_text)):
+        values = sorted(set(values or []))
+        if not values:
+            continue
+        cur.execute(
+            """INSERT INTO image_label_counts (kind, value, count)
+               SELECT %s, value, %s FROM unnest(%s::text[]) AS value
+               ON CONFLICT (kind, value) DO UPDATE SET count = image_label_counts.count + EXCLUDED.count""",
+            (kind, amount, values))
+        # Only the keys just decremented can have dropped to zero
+        if amount < 0:
+            cur.execute(
+                "DELETE FROM image_label_counts WHERE kind = %s AND value = ANY(%s) AND count <= 0",
+                (kind, values))
+        if day is not None:
+            cur.execute(
+                """INSERT INTO image_label_daily_counts (kind, value, day, count)
+                   SELECT %s, value, %s, %s FROM unnest(%s::text[]) AS value
+                   ON CONFLICT (kind, value, day) DO UPDATE SET count = image_label_daily_counts.count + EXCLUDED.count""",
+                (kind, day, amount, values))
+            if amount < 0:
+                cur.execute(
+                    "DELETE FROM image_label_daily_counts WHERE kind = %s AND day = %s AND value = ANY(%s) AND count <= 0",
+                    (kind, day, values))
+
+    labels = sorted(set(ai_labels or []))
+    if len(labels) > 1:
+        cur.execute(
+            """INSERT INTO image_label_pairs (a, b, count)
+               SELECT a, b, %s FROM unnest(%s::text[]) AS a CROSS JOIN unnest(%s::text[]) AS b WHERE a < b
+               ON CONFLICT (a, b) DO UPDATE SET count = image_label_pairs.count + EXCLUDED.count""",
+            (amount, labels, labels))
+        if amount < 0:
+            cur.execute(
+                "DELETE FROM image_label_pairs WHERE a = ANY(%s) AND b = ANY(%s) AND count <= 0",
+                (labels, labels))
+
+
+def apply_label_stats_postgres(cur, day: date, ai_labels: list, ai_text: list, amount: int):
+    """Updates the analytics tables without risking the surrounding image write
+
+    The update runs in a savepoint, so a failure (e.g. the tables could not be
+    created) only leaves the summaries stale until POST /analytics/rebuild.
+
+    Args:
+        cur (cursor): A cursor inside the transaction that changed the image
+        day (date): The day the image was added, None skips the daily counts
+        ai_labels (list): Labels identified by Amazon Rekognition
+        ai_text (list): Text identified by Amazon Rekognition
+        amount (int): 1 when the image was added, -1 when it was deleted
+    """
+    cur.execute("SAVEPOINT label_stats")
+    try:
+        update_label_stats_postgres(cur, day, ai_labels, ai_text, amount)
+        cur.execute("RELEASE SAVEPOINT label_stats")
+    except Exception as err:
+        cur.execute("ROLLBACK TO SAVEPOINT label_stats")
+        capture_exception(err)
+
+
+def prepare_label_stats_postgres():
+    """Creates the analytics tables on first use if startup could not"""
+    if label_stats_ready:
+        return
+    try:
+        ensure_label_stats_postgres()
+    except Exception:
+        # Already reported, the image write goes ahead without analytics
+        pass
+
+
+def rebuild_label_stats_postgres():
+    """Recomputes the analytics tables from scratch with unnest / GROUP BY"""
+    with configure_scope() as scope:
+        scope.set_transaction_name("Postgres Rebuild Label Stats")
+
+    cur = conn.cursor()
+    try:
+        cur.execute("TRUNCATE image_label_counts, image_label_daily_counts, image_label_pairs")
+        for kind, column in (("label", "ai_labels"), ("text", "ai_text")):
+            cur.execute(
+                f"""INSERT INTO image_label_counts (kind, value, count)
+                    SELECT %s, value, count(DISTINCT id) FROM images CROSS JOIN LATERAL unnest({column}) AS value
+                    GROUP BY value""",
+                (kind,))
+            cur.execute(
+                f"""INSERT INTO image_label_daily_counts (kind, value, day, count)
+                    SELECT %s, value, date_added, count(DISTINCT id) FROM images CROSS JOIN LATERAL unnest({column}) AS value
+                    WHERE date_added IS NOT NULL GROUP BY value, date_added""",
+                (kind,))
+        cur.execute(
+            """INSERT INTO image_label_pairs (a, b, count)
+               SELECT a, b, count(DISTINCT id) FROM images
+               CROSS JOIN LATERAL unnest(ai_labels) AS a CROSS JOIN LATERAL unnest(ai_labels) AS b
+               WHERE a < b GROUP BY a, b""")
+        conn.commit()
+    except Exception as err:
+        conn.rollback()
+        capture_exception(err)
+        raise
+    finally:
+        cur.close()
+
+
+def ensure_label_stats_postgres():
+    """Creates the analytics tables and backfills them on first run"""
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS image_label_counts (
+                   kind text NOT NULL, value text NOT NULL, count integer NOT NULL,
+                   PRIMARY KEY (kind, value))""")
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS image_label_daily_counts (
+                   kind text NOT NULL, value text NOT NULL, day date NOT NULL, count integer NOT NULL,
+                   PRIMARY KEY (kind, value, day))""")
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS image_label_pairs (
+                   a text NOT NULL, b text NOT NULL, count integer NOT NULL,
+                   PRIMARY KEY (a, b))""")
+        cur.execute("CREATE INDEX IF NOT EXISTS image_label_counts_rank ON image_label_counts (kind, count DESC)")
+        cur.execute("CREATE INDEX IF NOT EXISTS image_label_daily_counts_day ON image_label_daily_counts (kind, day)")
+        cur.execute(
+            """SELECT NOT EXISTS (SELECT 1 FROM image_label_counts)
+                      AND EXISTS (SELECT 1 FROM images WHERE ai_labels <> '{}' OR ai_text <> '{}')""")
+        backfill = cur.fetchone()[0]
+        conn.commit()
+    except Exception as err:
+        conn.rollback()
+        capture_exception(err)
+        raise
+    finally:
+        cur.close()
+    if backfill:
+        rebuild_label_stats_postgres()
+
+    global label_stats_ready
+    label_stats_ready = True
+
+
+def top_labels_postgres(kind: str, limit: int) -> list:
+    """Most frequent labels (or text lines) across all images"""
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            "SELECT value, count FROM image_label_counts WHERE kind = %s ORDER BY count DESC LIMIT %s",
+            (kind, limit))
+        return [{"value": value, "count": count} for value, count in cur.fetchall()]
+    except Exception as err:
+        conn.rollback()
+        capture_exception(err)
+        raise
+    finally:
+        cur.close()
+
+
+def label_counts_over_time_postgres(kind: str, value: str = None, start: date = None, end: date = None) -> list:
+    """Images added per day carrying each label (or text line)"""
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """SELECT day, value, count FROM image_label_daily_counts
+               WHERE kind = %s AND (%s IS NULL OR value = %s)
+                 AND (%s::date IS NULL OR day >= %s) AND (%s::date IS NULL OR day <= %s)
+               ORDER BY day, count DESC""",
+            (kind, value, value, start, start, end, end))
+        return [{"day": day.isoformat(), "value": value, "count": count} for day, value, count in cur.fetchall()]
+    except Exception as err:
+        conn.rollback()
+        capture_exception(err)
+        raise
+    finally:
+        cur.close()
+
+
+def co_occurrence_postgres(label: str = None, limit: int = 20) -> list:
+    """Label pairs appearing on the same image, optionally involving one label"""
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """SELECT a, b, count FROM image_label_pairs
+               WHERE %s::text IS NULL OR a = %s OR b = %s
+               ORDER BY count DESC LIMIT %s""",
+            (label, label, label, limit))
+        return [{"a": a, "b": b, "count": count} for a, b, count in cur.fetchall()]
+    except Exception as err:
+        conn.rollback()
+        capture_exception(err)
+        raise
+    finally:
+        cur.close()
+
+
+def notify_image_event_postgres(cur, event: dict):
+    """Queues a NOTIFY for an image event, delivered to listeners on commit
+
+    Args:
+        cur (cursor): A cursor inside the transaction that changed the image
+        event (dict): The image event
+    """
+    cur.execute("SELECT pg_notify(%s, %s)", (EVENTS_CHANNEL, json.dumps(event)))
+
+
+def publish_image_event_postgres(event: dict):
+    """Publishes an image event to this worker when no LISTEN connection will
+
+    Args:
+        event (dict): The image event
+    """
+    if not broker.has_source("postgres"):
+        broker.publish(event)
+
+
+def listen_images_postgres():
+    """Relays image NOTIFY payloads to the event broker
+
+    Runs forever in a background thread on its own autocommit connection,
+    so events from every worker reach this worker's subscribers.
+    """
+    while True:
+        listen_conn = None
+        try:
+            # TCP keepalives so a silently dropped connection errors out in about a minute
+            listen_conn = psycopg2.connect(
+                database=DB, user=USER, password=PW, host=HOST, port=PORT,
+                keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3
+            )
+            listen_conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = listen_conn.cursor()
+            cur.execute(f"LISTEN {EVENTS_CHANNEL}")
+            broker.sources.add("postgres")
+            while True:
+                # Wake up periodically and ping, so a dead connection raises and we reconnect
+                if select.select([listen_conn], [], [], 5) == ([], [], []):
+                    cur.execute("SELECT 1")
+                    continue
+                listen_conn.poll()
+                while listen_conn.notifies:
+                    notify = listen_conn.notifies.pop(0)
+                    broker.publish_threadsafe(json.loads(notify.payload))
+        except Exception as err:
+            capture_exception(err)
+        finally:
+            broker.sources.discard("postgres")
+            if listen_conn is not None:
+                listen_conn.close()
+        time.sleep(5)
+
+
+def start_listen_images_postgres():
+    """Starts the LISTEN loop in a daemon thread"""
+    threading.Thread(target=listen_images_postgres, name="postgres-listen", daemon=True).start()
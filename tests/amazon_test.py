@@ -0,0 +1,59 @@
+import io
+
+from PIL import Image
+
+from src.amazon import *
+
+
+def make_image(size, format, mode="RGB", exif=None):
+    output = io.BytesIO()
+    image = Image.new(mode, size)
+    if exif is not None:
+        image.save(output, format=format, exif=exif)
+    else:
+        image.save(output, format=format)
+    return output.getvalue()
+
+
+def test_prepare_image_passes_small_jpeg_and_png_through():
+    for format in ("JPEG", "PNG"):
+        image_bytes = make_image((640, 480), format)
+
+        assert amazon_prepare_image(image_bytes, max_dimension=1600) == image_bytes
+
+
+def test_prepare_image_caps_longest_side_and_reencodes_as_jpeg():
+    prepared = Image.open(io.BytesIO(amazon_prepare_image(make_image((4000, 2000), "PNG"), max_dimension=1600)))
+
+    assert prepared.format == "JPEG"
+    assert prepared.size == (1600, 800)
+
+
+def test_prepare_image_converts_unsupported_formats_and_modes():
+    prepared = Image.open(io.BytesIO(amazon_prepare_image(make_image((100, 100), "GIF", mode="P"))))
+    assert prepared.format == "JPEG"
+    assert prepared.mode == "RGB"
+
+    prepared = Image.open(io.BytesIO(amazon_prepare_image(make_image((3000, 3000), "PNG", mode="RGBA"), max_dimension=1000)))
+    assert prepared.format == "JPEG"
+    assert prepared.mode == "RGB"
+    assert prepared.size == (1000, 1000)
+
+
+def test_prepare_image_applies_exif_orientation():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotated 90 degrees, as phones store portrait shots
+    image_bytes = make_image((3200, 1600), "JPEG", exif=exif)
+
+    prepared = Image.open(io.BytesIO(amazon_prepare_image(image_bytes, max_dimension=1600)))
+
+    assert prepared.size == (800, 1600)
+
+
+def test_prepare_image_returns_unreadable_bytes_unchanged(monkeypatch):
+    assert amazon_prepare_image(b"not an image") == b"not an image"
+
+    # Anything over twice MAX_IMAGE_PIXELS raises DecompressionBombError
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    image_bytes = make_image((1000, 1000), "PNG")
+    assert amazon_prepare_image(image_bytes) == image_bytes
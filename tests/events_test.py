@@ -0,0 +1,56 @@
+import pytest
+
+from src.events import *
+
+
+@pytest.mark.asyncio
+async def test_publish_reaches_subscribers():
+    broker = EventBroker()
+    queue = broker.subscribe()
+
+    broker.publish(image_event("added", "mongo", "648b7444769c327f2a7cf0fe", "cat.jpg"))
+
+    event = queue.get_nowait()
+    assert event["id"] == f"{broker.epoch}-1"
+    assert event["type"] == "added"
+    assert event["image"] == {"id": "648b7444769c327f2a7cf0fe", "name": "cat.jpg"}
+
+
+@pytest.mark.asyncio
+async def test_subscribe_resumes_from_last_event_id():
+    broker = EventBroker()
+    for id in range(3):
+        broker.publish(image_event("added", "postgres", id))
+
+    queue = broker.subscribe(f"{broker.epoch}-1")
+
+    assert [queue.get_nowait()["image"]["id"] for _ in range(2)] == ["1", "2"]
+    assert queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_subscribe_with_unknown_id_resets():
+    broker = EventBroker(history=2)
+    for id in range(5):
+        broker.publish(image_event("deleted", "postgres", id))
+
+    assert broker.subscribe(f"{broker.epoch}-1").get_nowait() == {"type": "reset"}
+    assert broker.subscribe("otherworker-4").get_nowait() == {"type": "reset"}
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_is_reset():
+    broker = EventBroker(buffer=2)
+    queue = broker.subscribe()
+    for id in range(3):
+        broker.publish(image_event("added", "mongo", id))
+
+    assert queue.get_nowait() == {"type": "reset"}
+    assert queue.empty()
+
+
+def test_format_sse():
+    message = format_sse({"id": "abc-1", "type": "deleted", "image": {"id": "7"}})
+
+    assert message.startswith("id: abc-1\nevent: deleted\ndata: {")
+    assert message.endswith("\n\n")
@@ -0,0 +1,28 @@
+from src.http_cache import *
+
+
+def test_make_etag_is_stable_and_quoted():
+    etag = make_etag("mongo", 3, "648b7444769c327f2a7cf0fe")
+
+    assert etag == make_etag("mongo", 3, "648b7444769c327f2a7cf0fe")
+    assert etag != make_etag("mongo", 4, "648b7444769c327f2a7cf0fe")
+    assert etag.startswith('"') and etag.endswith('"')
+
+
+def test_etag_matches():
+    etag = make_etag("postgres", 10, 42)
+
+    assert etag_matches(etag, etag)
+    assert etag_matches(f'"other", W/{etag}', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches(None, etag)
+    assert not etag_matches('"other"', etag)
+
+
+def test_not_modified_carries_cache_headers():
+    etag = make_etag("mongo", 1, None)
+    response = not_modified(etag, 5)
+
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.headers["cache-control"] == "public, max-age=5, must-revalidate"
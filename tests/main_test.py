@@ -0,0 +1,85 @@
+from fastapi.testclient import TestClient
+
+import main
+import src.mongo
+import src.postgres
+from src.http_cache import make_etag
+
+# Not used as a context manager, so the startup hooks don't run
+client = TestClient(main.app)
+
+
+async def fail_fetch():
+    raise AssertionError("a matching If-None-Match must not fetch the listing")
+
+
+class FakeCollection:
+    def find_one(self, *args, **kwargs):
+        return {"_id": "648b7444769c327f2a7cf0fe"}
+
+
+class FakeCursor:
+    def execute(self, sql, data=None):
+        pass
+
+    def fetchone(self):
+        return (1,)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def cursor(self):
+        return FakeCursor()
+
+    def rollback(self):
+        pass
+
+
+def test_images_not_modified(monkeypatch):
+    etag = make_etag("mongo", 7)
+    monkeypatch.setattr(main, "get_images_version_mongo", lambda: etag)
+    monkeypatch.setattr(main, "get_all_images_mongo", fail_fetch)
+
+    response = client.get("/images", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert "max-age" in response.headers["cache-control"]
+
+
+def test_images_postgres_not_modified(monkeypatch):
+    etag = make_etag("postgres", 7)
+    monkeypatch.setattr(main, "get_images_version_postgres", lambda: etag)
+    monkeypatch.setattr(main, "get_all_images_postgres", fail_fetch)
+
+    response = client.get("/images?backend=postgres", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+
+def test_get_image_mongo_not_modified(monkeypatch):
+    id = "648b7444769c327f2a7cf0fe"
+    monkeypatch.setattr(src.mongo, "collection", FakeCollection())
+
+    response = client.get(f"/get-image-mongo/{id}", headers={"If-None-Match": make_etag("mongo", id)})
+
+    assert response.status_code == 304
+    assert response.headers["etag"] == make_etag("mongo", id)
+
+
+def test_get_image_postgres_not_modified(monkeypatch):
+    monkeypatch.setattr(src.postgres, "conn", FakeConnection())
+
+    response = client.get("/get-image-postgres/1", headers={"If-None-Match": make_etag("postgres", 1)})
+
+    assert response.status_code == 304
+    assert response.headers["etag"] == make_etag("postgres", 1)
+
+
+def test_analytics_limit_is_validated():
+    for limit in (0, -1, 1001):
+        assert client.get(f"/analytics/top-labels?limit={limit}").status_code == 422
+        assert client.get(f"/analytics/co-occurrence?limit={limit}").status_code == 422
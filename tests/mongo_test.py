@@ -4,6 +4,7 @@ from unittest.mock import AsyncMock
 
 import pytest
 
+import src.mongo
 from src.mongo import *
 
 print(os.getcwd())
@@ -39,3 +40,67 @@ async def test_get_all_images_mongo(monkeypatch):
         assert isinstance(item, dict)
         expected_keys = {"name", "url", "ai_labels", "ai_text", "id"}
         assert expected_keys.issubset(item.keys())
+
+
+@pytest.fixture
+def scratch_stats(monkeypatch):
+    # Point the analytics at throwaway collections so tests never touch the
+    # live images, summaries or /events subscribers
+    prefix = f"test_{ObjectId()}"
+    scratch = {name: db[f"{prefix}_{name}"]
+               for name in ("collection", "label_counts", "label_daily_counts", "label_pairs")}
+    for name, stats in scratch.items():
+        monkeypatch.setattr(src.mongo, name, stats)
+    yield scratch
+    for stats in scratch.values():
+        stats.drop()
+
+
+def add_scratch_image(scratch, ai_labels, ai_text):
+    image_id = scratch["collection"].insert_one(
+        {"name": "test.jpg", "ai_labels": ai_labels, "ai_text": ai_text}).inserted_id
+    update_label_stats_mongo(image_id, ai_labels, ai_text, 1)
+    return image_id
+
+
+def test_top_labels_and_co_occurrence_mongo(scratch_stats):
+    add_scratch_image(scratch_stats, ["Cat", "Dog"], ["HELLO"])
+    add_scratch_image(scratch_stats, ["Cat", "Dog"], [])
+    add_scratch_image(scratch_stats, ["Cat", "Tree"], [])
+
+    assert top_labels_mongo("label", 2) == [{"value": "Cat", "count": 3}, {"value": "Dog", "count": 2}]
+    assert top_labels_mongo("text", 5) == [{"value": "HELLO", "count": 1}]
+    assert co_occurrence_mongo("Cat") == [
+        {"a": "Cat", "b": "Dog", "count": 2}, {"a": "Cat", "b": "Tree", "count": 1}]
+    assert co_occurrence_mongo("Dog") == [{"a": "Cat", "b": "Dog", "count": 2}]
+
+
+def test_label_stats_mongo_insert_then_delete_nets_out(scratch_stats):
+    add_scratch_image(scratch_stats, ["Cat", "Dog"], ["HELLO"])
+    image_id = add_scratch_image(scratch_stats, ["Cat", "Dog", "Cat"], [])
+
+    update_label_stats_mongo(image_id, ["Cat", "Dog", "Cat"], [], -1)
+
+    assert scratch_stats["label_counts"].find_one({"_id": {"kind": "label", "value": "Cat"}})["count"] == 1
+    assert scratch_stats["label_pairs"].find_one({"_id": {"a": "Cat", "b": "Dog"}})["count"] == 1
+
+    image_id = scratch_stats["collection"].find_one({"ai_text": "HELLO"})["_id"]
+    update_label_stats_mongo(image_id, ["Cat", "Dog"], ["HELLO"], -1)
+
+    for name in ("label_counts", "label_daily_counts", "label_pairs"):
+        assert scratch_stats[name].count_documents({}) == 0
+
+
+def test_rebuild_label_stats_mongo_matches_incremental(scratch_stats):
+    add_scratch_image(scratch_stats, ["Cat", "Dog", "Tree"], ["HELLO", "WORLD"])
+    add_scratch_image(scratch_stats, ["Cat", "Dog"], ["HELLO"])
+    add_scratch_image(scratch_stats, ["Bug"], [])
+
+    def snapshot():
+        return {name: {tuple(doc["_id"].values()): doc["count"] for doc in scratch_stats[name].find()}
+                for name in ("label_counts", "label_daily_counts", "label_pairs")}
+
+    incremental = snapshot()
+    rebuild_label_stats_mongo()
+
+    assert snapshot() == incremental